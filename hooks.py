@@ -1,45 +1,152 @@
+import os
+import re
+import sys
 import time
-import json
+import queue
+import threading
+import functools
+from collections import Counter
 import tiktoken
 from cat.mad_hatter.decorators import hook
-from cat.log import log
 from cat.db import crud
-from cat.convo.messages import CatMessage
 from .metrics import (
     MESSAGE_COUNTER, BROWSER_LANGUAGE_MESSAGES, SENTIMENT_SCORE, SENTIMENT_COUNTS, NEW_SESSIONS, RAG_DOCUMENTS_RETRIEVED,
     AVG_MESSAGES_PER_CHAT, MAX_MESSAGES_PER_CHAT, LLM_INPUT_TOKENS_TOTAL, LLM_OUTPUT_TOKENS_TOTAL,
     LLM_INPUT_TOKENS_AVG, LLM_OUTPUT_TOKENS_AVG, EMBEDDING_TOKENS_TOTAL, NO_RELEVANT_MEMORY_COUNTER,
-    RESPONSE_TIME_SUM, RESPONSE_TIME_COUNT, RESPONSE_TIME_MAX
+    RESPONSE_TIME
 )
-from .sentiment import analyze_sentiment
+from .sentiment import analyze_sentiment_batch, is_neutral_text, is_sentiment_available
+from .utils import LRUDict, get_plugin_settings, log_error
 
-# Global state for simple tracking (Note: this resets on restart and grows with unique users)
-USER_MESSAGE_COUNTS = {}
+# Global state for simple tracking (Note: this resets on restart)
+# Per-user message counts, bounded to ~10MB: least recently active users are evicted past the limit
+USER_MESSAGE_COUNTS = LRUDict(100000)
+_total_messages = 0
+_total_sessions = 0
+_max_messages = 0
+_last_avg_messages = 0.0
+_avg_messages_epsilon = 0.01
+# Hooks run on several threads, LRUDict and the running aggregates are only touched under this lock
+_user_stats_lock = threading.Lock()
+
+# Per-model LLM stats, model name -> calls and token totals
 _llm_stats = {}
-_max_response_time = 0.0
+
+# Label values with their own series, further distinct values are counted as "other"
+_seen_sources = set()
+_max_sources = 500
+_seen_models = set()
+_max_models = 20
+# Model-labelled children, bound on first use
+_model_children = {}
+
+# Messages waiting for sentiment analysis, processed off the request path
+_sentiment_queue = queue.Queue(maxsize=1024)
+_sentiment_batch_size = 32
+# Worker thread, started on the first queued message and stopped when idle,
+# so a reloaded plugin doesn't leave a thread waiting on the old queue forever
+_sentiment_worker_thread = None
+_sentiment_worker_lock = threading.Lock()
+_sentiment_worker_idle_timeout = 60 # seconds
+
+# Resolved model names, keyed by the identity of the LLM/embedder object
+_llm_name_cache = {"key": None, "name": None, "ts": float("-inf")}
+_embedder_name_cache = {"key": None, "name": None, "ts": float("-inf")}
+_name_cache_ttl = 60 # seconds
+
+# Labelled children bound once, only user messages are counted and analyzed for sentiment
+_user_messages = MESSAGE_COUNTER.labels(sender='user')
+_SENTIMENT_TYPES = ("negative", "neutral", "positive")
+_user_sentiment_score = SENTIMENT_SCORE.labels(sender='user')
+_user_sentiment_counts = tuple(SENTIMENT_COUNTS.labels(sender='user', type=t) for t in _SENTIMENT_TYPES)
+# Browser language children, bound on first use
+_browser_language_children = {}
+# Languages with their own label value, anything else is counted as "other" to bound cardinality
+_ALLOWED_LANGS = frozenset({"en", "it", "es", "fr", "de", "pt", "zh", "ja", "ar", "ru", "nl"})
+
+# Optional protocol, host and first path segment of a RAG source
+_SOURCE_CLUSTER_RE = re.compile(r'^((?:[^/]*://)?[^/]*(?:/[^/]*)?)')
+
+# Tokenizer used to count embedding tokens, loaded once per process
+_tiktoken_encoding = None
+_tiktoken_lock = threading.Lock()
+_tiktoken_failed_at = float("-inf")
+_tiktoken_retry_interval = 300 # seconds
+
+# Token counts of recently embedded texts keyed by hash(text), so re-ingested chunks are not encoded again
+_token_count_cache = LRUDict(4096)
+_token_count_lock = threading.Lock()
+
+def _bounded_label(seen, limit, value):
+    # The first `limit` distinct values keep their own series, so each series stays monotonic
+    if value not in seen:
+        if len(seen) >= limit:
+            return "other"
+        seen.add(value)
+    return value
+
+def _model_child(metric, model_name):
+    # Model names are capped by _max_models, so every (metric, model) child can be kept
+    key = (metric, model_name)
+    child = _model_children.get(key)
+    if child is None:
+        child = _model_children[key] = metric.labels(model=model_name)
+    return child
 
 def _update_llm_stats(model_name, input_tokens, output_tokens):
-    if model_name not in _llm_stats:
-        _llm_stats[model_name] = {
-            'count': 0,
-            'total_input': 0,
-            'total_output': 0
-        }
+    stats = _llm_stats.get(model_name)
+    if stats is None:
+        stats = _llm_stats[model_name] = {'count': 0, 'total_input': 0, 'total_output': 0}
     
-    stats = _llm_stats[model_name]
     stats['count'] += 1
     stats['total_input'] += input_tokens
     stats['total_output'] += output_tokens
     
     # Update Gauges
-    if stats['count'] > 0:
-        avg_input = stats['total_input'] / stats['count']
-        avg_output = stats['total_output'] / stats['count']
-        
-        LLM_INPUT_TOKENS_AVG.labels(model=model_name).set(avg_input)
-        LLM_OUTPUT_TOKENS_AVG.labels(model=model_name).set(avg_output)
+    count = stats['count']
+    _model_child(LLM_INPUT_TOKENS_AVG, model_name).set(stats['total_input'] / count)
+    _model_child(LLM_OUTPUT_TOKENS_AVG, model_name).set(stats['total_output'] / count)
 
-def _get_llm_name(cat):
+def _get_encoding():
+    # Building the BPE tokenizer is expensive, so we do it only once and reuse it.
+    # If it fails (e.g. the BPE file can't be downloaded) we retry only after a while
+    global _tiktoken_encoding, _tiktoken_failed_at
+    if _tiktoken_encoding is None:
+        with _tiktoken_lock:
+            if _tiktoken_encoding is None:
+                if time.monotonic() - _tiktoken_failed_at < _tiktoken_retry_interval:
+                    return None
+                try:
+                    _tiktoken_encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _tiktoken_failed_at = time.monotonic()
+                    return None
+    return _tiktoken_encoding
+
+def _count_tokens(encoding, texts):
+    keys = [hash(text) for text in texts]
+    counts = {}
+    missing = {}
+    with _token_count_lock:
+        for key, text in zip(keys, texts):
+            count = _token_count_cache.get(key)
+            if count is None:
+                missing[key] = text
+            else:
+                counts[key] = count
+                _token_count_cache.move_to_end(key)
+
+    if missing:
+        # Batch encoding runs on tiktoken's native thread pool, much faster than a per-doc loop.
+        # Documents are plain content, so the special tokens scan of encode() is skipped
+        encoded = encoding.encode_ordinary_batch(list(missing.values()), num_threads=os.cpu_count() or 1)
+        with _token_count_lock:
+            for key, ids in zip(missing, encoded):
+                counts[key] = _token_count_cache[key] = len(ids)
+
+    return [counts[key] for key in keys]
+
+def _resolve_llm_name(cat):
     try:
         # Try to get from settings first as it is more reliable for the configured name
         selected_llm = crud.get_setting_by_name("llm_selected")
@@ -54,17 +161,12 @@ def _get_llm_name(cat):
         
         # Fallback to inspecting the object
         llm = cat._llm
-        if hasattr(llm, "model_name"):
-            return llm.model_name
-        if hasattr(llm, "model"):
-            return llm.model
-        if hasattr(llm, "repo_id"):
-            return llm.repo_id
-        return llm.__class__.__name__
-    except:
+        return (getattr(llm, "model_name", None) or getattr(llm, "model", None)
+                or getattr(llm, "repo_id", None) or type(llm).__name__)
+    except Exception:
         return "unknown"
 
-def _get_embedder_name(cat):
+def _resolve_embedder_name(cat):
     try:
         # Try to get from settings first as it is more reliable for the configured name
         selected_embedder = crud.get_setting_by_name("embedder_selected")
@@ -79,135 +181,200 @@ def _get_embedder_name(cat):
         
         # Fallback to inspecting the object
         embedder = cat.embedder
-        if hasattr(embedder, "model_name"):
-            return embedder.model_name
-        if hasattr(embedder, "model"):
-            return embedder.model
-        return embedder.__class__.__name__
-    except:
+        return getattr(embedder, "model_name", None) or getattr(embedder, "model", None) or type(embedder).__name__
+    except Exception:
         return "unknown"
 
+def _get_cached_name(cache, obj, resolver, cat):
+    # Model names only change when the Cat swaps the LLM/embedder object, so we resolve them
+    # once per object instead of reading settings on every call. The TTL guards against
+    # settings edited in place and against a new object reusing a freed id
+    key = id(obj)
+    now = time.monotonic()
+    if cache["key"] == key and cache["name"] is not None and now - cache["ts"] < _name_cache_ttl:
+        return cache["name"]
+
+    # Interned, so every label lookup with this name hits the same string object
+    name = sys.intern(str(resolver(cat)))
+    if name != "unknown":
+        cache["key"] = key
+        cache["name"] = name
+        cache["ts"] = now
+    return name
+
+def _get_llm_name(cat):
+    return _get_cached_name(_llm_name_cache, getattr(cat, "_llm", None), _resolve_llm_name, cat)
+
+def _get_embedder_name(cat):
+    return _get_cached_name(_embedder_name_cache, getattr(cat, "embedder", None), _resolve_embedder_name, cat)
+
 @hook(priority=9)
 def before_rabbithole_stores_documents(docs, cat):
     try:
-        model_name = _get_embedder_name(cat)
+        model_name = _bounded_label(_seen_models, _max_models, _get_embedder_name(cat))
         
         # Count tokens - using tiktoken's cl100k_base as a standard approximation
         # Ideally we'd use the specific tokenizer for the model, but this is a reasonable default
-        encoding = None
-        try:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        except Exception:
-             pass
+        encoding = _get_encoding()
+        texts = [doc.page_content for doc in docs]
 
-        for doc in docs:
-            text = doc.page_content
-            tokens = 0
+        token_counts = None
+        if encoding:
             try:
-                if encoding:
-                    tokens = len(encoding.encode(text))
-                else:
-                    tokens = len(text.split())
+                token_counts = _count_tokens(encoding, texts)
             except Exception:
-                 # Fallback if tiktoken fails
-                 tokens = len(text.split()) 
+                token_counts = None
+
+        if token_counts is None:
+            # Fallback if tiktoken is not available or fails.
+            # str.split() is still the cheapest exact word count in CPython
+            token_counts = [len(text.split()) for text in texts]
 
-            EMBEDDING_TOKENS_TOTAL.labels(model=model_name).inc(tokens)
+        _model_child(EMBEDDING_TOKENS_TOTAL, model_name).inc(sum(token_counts))
         
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "embedding_token_tracking_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("embedding_token_tracking_error", e)
     
     return docs
 
-def _track_sentiment(sender, text):
-    """Track sentiment polarity and classify into negative/neutral/positive.
+def _observe_sentiment(sentiment):
+    """Record a sentiment polarity and classify into negative/neutral/positive.
     
-    Uses spacytextblob polarity score (-1 to 1):
+    Uses TextBlob polarity score (-1 to 1):
     - Negative: polarity < -0.05
     - Neutral: -0.05 <= polarity <= 0.05
     - Positive: polarity > 0.05
     """
-    sentiment = analyze_sentiment(text)
-    SENTIMENT_SCORE.labels(sender=sender).observe(sentiment)
+    _user_sentiment_score.observe(sentiment)
     
     # Classify sentiment based on polarity thresholds
     # TextBlob polarity around 0 is neutral, so we use a small threshold
-    sentiment_type = "neutral"
-    if sentiment < -0.05:
-        sentiment_type = "negative"
-    elif sentiment > 0.05:
-        sentiment_type = "positive"
-        
-    SENTIMENT_COUNTS.labels(sender=sender, type=sentiment_type).inc()
+    # The comparisons give an index into (negative, neutral, positive)
+    _user_sentiment_counts[(sentiment > 0.05) - (sentiment < -0.05) + 1].inc()
 
+def _sentiment_worker():
+    # Drain queued messages in batches, one wakeup scores everything that piled up
+    global _sentiment_worker_thread
+    while True:
+        try:
+            texts = [_sentiment_queue.get(timeout=_sentiment_worker_idle_timeout)]
+        except queue.Empty:
+            with _sentiment_worker_lock:
+                # A message queued meanwhile saw this thread as running, keep going for it
+                if not _sentiment_queue.empty():
+                    continue
+                _sentiment_worker_thread = None
+                return
+
+        while len(texts) < _sentiment_batch_size:
+            try:
+                texts.append(_sentiment_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            for sentiment in analyze_sentiment_batch(texts):
+                if sentiment is not None:
+                    _observe_sentiment(sentiment)
+        except Exception as e:
+            log_error("sentiment_tracking_error", e)
+
+def _track_sentiment(text):
+    """Queue a user message for sentiment analysis.
+    
+    Sentiment is only observational, so it is computed by a background worker
+    instead of delaying the reply. Messages are dropped if the queue is full.
+    Messages with fewer than 3 letters ("ok", emoji, numbers) are neutral.
+    """
+    if is_neutral_text(text):
+        # Without a scorer nothing is recorded, short messages included, or the distribution would be all neutral
+        if is_sentiment_available():
+            _observe_sentiment(0.0)
+        return
+
+    try:
+        _sentiment_queue.put_nowait(text)
+    except queue.Full:
+        return
+
+    _ensure_sentiment_worker()
+
+def _ensure_sentiment_worker():
+    global _sentiment_worker_thread
+    with _sentiment_worker_lock:
+        if _sentiment_worker_thread is None:
+            _sentiment_worker_thread = threading.Thread(target=_sentiment_worker, name="oc_analytics_sentiment", daemon=True)
+            _sentiment_worker_thread.start()
+
+@functools.lru_cache(maxsize=4096)
 def _cluster_source(source: str) -> str:
     if not source:
         return "unknown"
     
     # Remove trailing slash if present
     source = source.rstrip('/')
-    
-    # Handle URLs with protocol
-    if '://' in source:
-        try:
-            protocol, rest = source.split('://', 1)
-            if rest.count('/') > 1:
-                rest = rest.rsplit('/', 1)[0]
-            return f"{protocol}://{rest}"
-        except ValueError:
-            pass
-
-    # If there is more than one slash, remove the last segment
+
+    # Plain names (e.g. uploaded files) have nothing to cluster
+    if '/' not in source:
+        return source
+
+    # Keep only the host (with its protocol) and the first path segment, so the
+    # number of label values stays bounded by sections rather than by pages
     # e.g. example.com/services/s1 -> example.com/services
+    # e.g. https://example.com/services/s1/page -> https://example.com/services
     # e.g. example.com/services -> example.com/services
-    if source.count('/') > 1:
-        return source.rsplit('/', 1)[0]
-        
-    return source
+    return _SOURCE_CLUSTER_RE.match(source).group(1)
 
 @hook
 def before_cat_reads_message(user_message_json, cat):
     # Store start time for response time calculation
-    cat.working_memory.oc_analytics_start_time = time.time()
+    # perf_counter is monotonic, so wall clock adjustments can't skew durations
+    cat.working_memory.oc_analytics_start_time = time.perf_counter()
 
     # Track user message
-    MESSAGE_COUNTER.labels(sender='user').inc()
+    _user_messages.inc()
 
     # Browser language tracking
     info = user_message_json.get('info', {})
-    lang = None
-    if isinstance(info, dict):
-        bl = info.get('browser_lang')
-        if bl and isinstance(bl, str):
-            lang = bl.split('-')[0].lower()
-    elif isinstance(info, str):
-        lang = info.split('-')[0].lower()
-    if lang:
-        BROWSER_LANGUAGE_MESSAGES.labels(lang=lang).inc()
+    bl = info.get('browser_lang') if isinstance(info, dict) else info
+    if bl and isinstance(bl, str):
+        lang = bl.partition('-')[0].lower()
+        if lang:
+            if lang not in _ALLOWED_LANGS:
+                lang = "other"
+            child = _browser_language_children.get(lang)
+            if child is None:
+                child = _browser_language_children[lang] = BROWSER_LANGUAGE_MESSAGES.labels(lang=lang)
+            child.inc()
 
     # Update user stats
+    global _total_messages, _total_sessions, _max_messages, _last_avg_messages
     user_id = cat.user_id
-    if user_id not in USER_MESSAGE_COUNTS:
-        NEW_SESSIONS.inc()
+    with _user_stats_lock:
+        count = USER_MESSAGE_COUNTS.get(user_id)
+        if count is None:
+            NEW_SESSIONS.inc()
+            _total_sessions += 1
+            count = 0
+
+        count += 1
+        USER_MESSAGE_COUNTS[user_id] = count
         
-    USER_MESSAGE_COUNTS[user_id] = USER_MESSAGE_COUNTS.get(user_id, 0) + 1
-    
-    # Update Gauges
-    counts = list(USER_MESSAGE_COUNTS.values())
-    if counts:
-        AVG_MESSAGES_PER_CHAT.set(sum(counts) / len(counts))
-        MAX_MESSAGES_PER_CHAT.set(max(counts))
+        # Update Gauges incrementally, without scanning every user
+        # Gauges are only written when their value moves (the average by at least 0.01)
+        _total_messages += 1
+        avg = _total_messages / _total_sessions
+        if abs(avg - _last_avg_messages) >= _avg_messages_epsilon:
+            _last_avg_messages = avg
+            AVG_MESSAGES_PER_CHAT.set(avg)
+        if count > _max_messages:
+            _max_messages = count
+            MAX_MESSAGES_PER_CHAT.set(_max_messages)
     
     # Sentiment tracking
     text = user_message_json.get("text", "")
     if text:
-        _track_sentiment('user', text)
+        _track_sentiment(text)
             
     return user_message_json
 
@@ -215,22 +382,23 @@ def before_cat_reads_message(user_message_json, cat):
 def after_cat_recalls_memories(cat):
     # Declarative memories (RAG)
     # cat.working_memory.declarative_memories is a list of tuples/lists where the first element is the Document
+    # Most recalled documents share a few sources, so count them first and update each series once
+    counts = Counter()
     for memory in cat.working_memory.declarative_memories:
         try:
             # memory[0] is the Document object
             doc = memory[0]
             if hasattr(doc, 'metadata'):
-                source = doc.metadata.get('source', 'unknown')
-                clustered_source = _cluster_source(source)
-                RAG_DOCUMENTS_RETRIEVED.labels(source=clustered_source).inc()
+                counts[doc.metadata.get('source', 'unknown')] += 1
         except Exception as e:
-            log.error(json.dumps({
-                "component": "ccat_oc_analytics",
-                "event": "rag_metrics_error",
-                "data": {
-                    "error": str(e)
-                }
-            }))
+            log_error("rag_metrics_error", e)
+
+    try:
+        for source, count in counts.items():
+            clustered_source = _bounded_label(_seen_sources, _max_sources, _cluster_source(source))
+            RAG_DOCUMENTS_RETRIEVED.labels(source=clustered_source).inc(count)
+    except Exception as e:
+        log_error("rag_metrics_error", e)
 
 @hook(priority=0)
 def fast_reply(message, cat):
@@ -241,31 +409,21 @@ def fast_reply(message, cat):
             return message
             
         # Get the text from the message (CatMessage or dict)
-        text = None
-        if isinstance(message, CatMessage):
-            text = message.text
-        elif isinstance(message, dict):
+        text = getattr(message, "text", None)
+        if text is None and isinstance(message, dict):
             text = message.get("output") or message.get("text")
             
         if text:
-            # Try to get the default message from context_guardian_enricher settings
-            # We access the plugin directly if available
-            plugin = cat.mad_hatter.plugins.get("ccat_context_guardian_enricher")
-            if plugin:
-                settings = plugin.load_settings()
+            # Try to get the default message from context_guardian_enricher settings, if the plugin is active
+            settings = get_plugin_settings("ccat_context_guardian_enricher")
+            if settings is not None:
                 default_message = settings.get('default_message', 'Sorry, I can\'t help you.')
                 
                 if text == default_message:
                     NO_RELEVANT_MEMORY_COUNTER.inc()
                     
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "fast_reply_check_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("fast_reply_check_error", e)
         
     return message
 
@@ -277,23 +435,13 @@ def before_cat_sends_message(message, cat):
     try:
         if hasattr(cat.working_memory, 'oc_analytics_start_time'):
             start_time = cat.working_memory.oc_analytics_start_time
-            duration = time.time() - start_time
-            
-            RESPONSE_TIME_SUM.inc(duration)
-            RESPONSE_TIME_COUNT.inc()
+            duration = time.perf_counter() - start_time
             
-            global _max_response_time
-            if duration > _max_response_time:
-                _max_response_time = duration
-                RESPONSE_TIME_MAX.set(_max_response_time)
+            # Never record a negative duration (e.g. a start time set by another clock)
+            if duration >= 0:
+                RESPONSE_TIME.observe(duration)
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "response_time_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("response_time_error", e)
         
     # Token Usage & LLM Name
     try:
@@ -304,21 +452,15 @@ def before_cat_sends_message(message, cat):
                 input_tokens = last_interaction.input_tokens
                 output_tokens = last_interaction.output_tokens
                 
-                model_name = _get_llm_name(cat)
+                model_name = _bounded_label(_seen_models, _max_models, _get_llm_name(cat))
                 
                 # Update Metrics
-                LLM_INPUT_TOKENS_TOTAL.labels(model=model_name).inc(input_tokens)
-                LLM_OUTPUT_TOKENS_TOTAL.labels(model=model_name).inc(output_tokens)
+                _model_child(LLM_INPUT_TOKENS_TOTAL, model_name).inc(input_tokens)
+                _model_child(LLM_OUTPUT_TOKENS_TOTAL, model_name).inc(output_tokens)
                 
                 _update_llm_stats(model_name, input_tokens, output_tokens)
    
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "token_tracking_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("token_tracking_error", e)
         
     return message
@@ -19,9 +19,9 @@ registry = CollectorRegistry()
 # ============================================================================
 
 MESSAGE_COUNTER = Counter('chatbot_chat_messages_total', 'Total number of messages', ['sender'], registry=registry)
-# Custom buckets for sentiment polarity (-1 to 1) from spacytextblob
+# Custom buckets for sentiment polarity (-1 to 1) from TextBlob
 # Buckets: very negative, negative, slightly negative, neutral, slightly positive, positive, very positive
-SENTIMENT_SCORE = Histogram('chatbot_chat_sentiment_score', 'Sentiment polarity score of messages from spacytextblob', ['sender'], 
+SENTIMENT_SCORE = Histogram('chatbot_chat_sentiment_score', 'Sentiment polarity score of messages from TextBlob', ['sender'], 
                             buckets=[-1.0, -0.6, -0.2, -0.05, 0.05, 0.2, 0.6, 1.0], registry=registry)
 SENTIMENT_COUNTS = Counter('chatbot_chat_sentiment_counts', 'Sentiment counts (negative, neutral, positive)', ['sender', 'type'], registry=registry)
 
@@ -42,9 +42,9 @@ BROWSER_LANGUAGE_MESSAGES = Counter('chatbot_chat_messages_by_browser_language_t
 
 NO_RELEVANT_MEMORY_COUNTER = Counter('chatbot_chat_no_relevant_memory_total', 'Total number of times no relevant memory was found', registry=registry)
 
-RESPONSE_TIME_SUM = Counter('chatbot_chat_response_time_seconds_sum', 'Sum of response times in seconds', registry=registry)
-RESPONSE_TIME_COUNT = Counter('chatbot_chat_response_time_seconds_count', 'Count of responses for average time calculation', registry=registry)
-RESPONSE_TIME_MAX = Gauge('chatbot_chat_response_time_seconds_max', 'Maximum response time in seconds', registry=registry)
+# Buckets sized for LLM replies, from sub-second to a couple of minutes
+RESPONSE_TIME = Histogram('chatbot_chat_response_time_seconds', 'Response time in seconds', 
+                          buckets=[0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0], registry=registry)
 
 CHATBOT_INSTANCE_INFO = Gauge('chatbot_instance_info', 'Global version information (Core and Frontend)', ['core_version', 'frontend_version'], registry=registry)
 CHATBOT_PLUGIN_INFO = Gauge('chatbot_plugin_info', 'Plugin version information', ['plugin_id', 'version'], registry=registry)
@@ -1,6 +1,6 @@
 import time
-import json
 import os
+import gzip
 import tomli
 from cat.mad_hatter.mad_hatter import MadHatter
 from cat.mad_hatter.decorators import endpoint
@@ -22,17 +22,74 @@ from .metrics import (
     FEEDBACK_THUMB_UP_TOTAL,
     FEEDBACK_THUMB_DOWN_TOTAL
 )
+from .utils import get_plugin_settings, log_error, log_event
 
 
 # Memory metrics caching
-_last_memory_update = 0
+_last_memory_update = float("-inf")
 _memory_update_interval = 3600 # seconds
+_facet_limit = 100000
+
+# Rendered metrics caching
+_metrics_cache = {"ts": float("-inf"), "body": b"", "gzip": None}
+_metrics_cache_ttl = 5 # seconds
+
+# Version metrics caching
+_core_version_initialized = False
+_plugins_snapshot = None
+
+def _count_sources_facet(collection):
+    # Distinct sources computed by Qdrant with a facet query (Qdrant >= 1.11).
+    # Needs a payload index on metadata.source, returns None if not possible
+    try:
+        result = collection.client.facet(
+            collection_name=collection.collection_name,
+            key="metadata.source",
+            limit=_facet_limit
+        )
+    except Exception:
+        return None
+
+    # The result may be truncated, count by scrolling instead
+    if len(result.hits) >= _facet_limit:
+        return None
+    return sum(1 for hit in result.hits if hit.value)
+
+def _count_sources_scroll(collection):
+    # Small pages keep only a few points in memory at a time
+    sources = set()
+    offset = None
+    limit = 1000
+    
+    while True:
+        points, offset = collection.client.scroll(
+            collection_name=collection.collection_name,
+            with_vectors=False,
+            with_payload=['metadata.source'], 
+            limit=limit,
+            offset=offset
+        )
+        
+        for point in points:
+            meta = point.payload.get('metadata') if point.payload else None
+            if isinstance(meta, dict):
+                source = meta.get('source')
+                if source:
+                    sources.add(source)
+
+        # Release the page before requesting the next one
+        points = None
+        
+        if offset is None:
+            break
+
+    return len(sources)
 
 def _update_memory_metrics():
     global _last_memory_update
     
     # Avoid frequent updates
-    if time.time() - _last_memory_update < _memory_update_interval:
+    if time.monotonic() - _last_memory_update < _memory_update_interval:
         return
 
     try:
@@ -57,55 +114,22 @@ def _update_memory_metrics():
                 points_count = col_info.points_count
                 VECTOR_MEMORY_POINTS_TOTAL.labels(collection=name).set(points_count)
                 
-                # 2. Count sources (expensive)
-                sources = set()
-                offset = None
-                limit = 100000
+                # 2. Count sources, server side if possible, otherwise scrolling all points (expensive)
+                sources_count = _count_sources_facet(collection)
+                if sources_count is None:
+                    sources_count = _count_sources_scroll(collection)
                 
-                while True:
-                    points, offset = collection.client.scroll(
-                        collection_name=collection.collection_name,
-                        with_vectors=False,
-                        with_payload=['metadata.source'], 
-                        limit=limit,
-                        offset=offset
-                    )
-                    
-                    for point in points:
-                        if point.payload and 'metadata' in point.payload:
-                            meta = point.payload.get('metadata', {})
-                            if isinstance(meta, dict):
-                                source = meta.get('source')
-                                if source:
-                                    sources.add(source)
-                    
-                    if offset is None:
-                        break
-                        
-                VECTOR_MEMORY_SOURCES_TOTAL.labels(collection=name).set(len(sources))
+                VECTOR_MEMORY_SOURCES_TOTAL.labels(collection=name).set(sources_count)
                      
             except Exception as e:
-                log.error(json.dumps({
-                    "component": "ccat_oc_analytics",
-                    "event": "memory_metrics_collection_error", 
-                    "data": {
-                        "collection": name,
-                        "error": str(e)
-                    }
-                }))
-
-        _last_memory_update = time.time()
+                log_event("ERROR", "memory_metrics_collection_error", collection=name, error=str(e))
+
+        _last_memory_update = time.monotonic()
         
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "memory_metrics_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("memory_metrics_error", e)
 
-def _update_version_metrics():
+def _update_core_version_metrics():
     # Core Version
     core_version = "unknown"
     try:
@@ -120,65 +144,93 @@ def _update_version_metrics():
                 data = tomli.load(f)
                 core_version = data.get("project", {}).get("version", "unknown")
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "core_version_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("core_version_error", e)
 
     # Frontend Version - currently we have no reliable way to get this from backend
     frontend_version = "unknown"
 
     CHATBOT_INSTANCE_INFO.labels(core_version=core_version, frontend_version=frontend_version).set(1)
 
-    # Plugin Versions
+def _update_version_metrics():
+    global _core_version_initialized, _plugins_snapshot
+
+    # The Core version only changes with a restart
+    if not _core_version_initialized:
+        _update_core_version_metrics()
+        _core_version_initialized = True
+
+    # Plugin Versions, only re-read when a plugin is (re)installed or removed
     try:
         mad_hatter = MadHatter()
-        for plugin_id, plugin in mad_hatter.plugins.items():
-            version = plugin.manifest.get("version", "unknown")
-            CHATBOT_PLUGIN_INFO.labels(plugin_id=plugin_id, version=version).set(1)
+        plugins = mad_hatter.plugins
+        snapshot = frozenset((plugin_id, id(plugin)) for plugin_id, plugin in plugins.items())
+        if snapshot != _plugins_snapshot:
+            for plugin_id, plugin in plugins.items():
+                version = plugin.manifest.get("version", "unknown")
+                CHATBOT_PLUGIN_INFO.labels(plugin_id=plugin_id, version=version).set(1)
+            _plugins_snapshot = snapshot
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "plugin_version_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("plugin_version_error", e)
 
-@endpoint.get("/metrics")
-def metrics():
+def _is_created_line(line):
+    # Samples start with the metric name (ending at '{' or ' '), HELP/TYPE comments have it as third word
+    if line.startswith(b'# '):
+        parts = line.split(b' ', 3)
+        name = parts[2] if len(parts) > 2 else b''
+    else:
+        name = line.split(b'{', 1)[0].split(b' ', 1)[0]
+    return name.endswith(b'_created')
+
+def _render_metrics():
     _update_version_metrics()
     _update_memory_metrics()
-    data = generate_latest(registry).decode('utf-8')
-    # Filter out _created lines to remove "garbage"
-    lines = []
-    for line in data.split('\n'):
-        # Check if line is a metric definition or comment
-        if line.startswith('#'):
-            lines.append(line)
-            continue
-            
-        # Check if metric name ends with _created
-        # Metric line format: name{labels} value [timestamp]
-        parts = line.split(' ')
-        if parts:
-            metric_part = parts[0]
-            # Remove labels to check name
-            metric_name = metric_part.split('{')[0]
-            
-            if metric_name.endswith('_created'):
-                continue
-                
-            if metric_name == 'chat_sentiment_score_bucket':
-                continue
-                
-        lines.append(line)
-        
-    filtered_data = "\n".join(lines)
-    return Response(filtered_data, media_type=CONTENT_TYPE_LATEST)
+    # Filter out _created series, they are not useful for dashboards.
+    # Done here rather than with disable_created_metrics(), which would change them for the whole process
+    return b'\n'.join(line for line in generate_latest(registry).split(b'\n') if not _is_created_line(line))
+
+def _accepts_gzip(accept_encoding):
+    # Comma separated codings, each with an optional q-value: "gzip;q=0" explicitly refuses gzip.
+    # An explicit gzip entry wins over the "*" wildcard
+    if not accept_encoding:
+        return False
+    wildcard = False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == "gzip":
+            return q > 0
+        if name == "*":
+            wildcard = q > 0
+    return wildcard
+
+@endpoint.get("/metrics")
+def metrics(accept_encoding: str = Header(None)):
+    # Scrapes within a few seconds of each other (several Prometheus replicas, federation)
+    # are served the same rendered body
+    now = time.monotonic()
+    if now - _metrics_cache["ts"] >= _metrics_cache_ttl:
+        _metrics_cache["body"] = _render_metrics()
+        _metrics_cache["ts"] = now
+    body = _metrics_cache["body"]
+
+    # Prometheus accepts gzip, the exposition format compresses very well.
+    # The compressed body is kept with the body it was made from, so it is compressed once per render
+    if _accepts_gzip(accept_encoding):
+        compressed = _metrics_cache["gzip"]
+        if compressed is None or compressed[0] is not body:
+            compressed = (body, gzip.compress(body, compresslevel=1))
+            _metrics_cache["gzip"] = compressed
+        return Response(compressed[1], media_type=CONTENT_TYPE_LATEST,
+                        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return Response(body, media_type=CONTENT_TYPE_LATEST, headers={"Vary": "Accept-Encoding"})
 
 
 @endpoint.post("/thumbup")
@@ -213,14 +265,12 @@ def thumbup(payload: dict, authorization: str = Header(None)):
         user_id = decoded.get("sub")
         
         # Get plugin settings to check prefix
-        mad_hatter = MadHatter()
-        auth_plugin = mad_hatter.plugins.get("ccat_temporary_chat_authentication")
+        settings = get_plugin_settings("ccat_temporary_chat_authentication")
         
-        if not auth_plugin:
+        if settings is None:
             log.warning("Received thumbup but ccat_temporary_chat_authentication plugin is not loaded")
             raise HTTPException(status_code=403, detail="Authentication plugin missing")
             
-        settings = auth_plugin.load_settings()
         prefix = settings.get("session_prefix", "sess_")
         
         if not user_id or not user_id.startswith(prefix):
@@ -1,254 +1,75 @@
-import json
-import sys
-import subprocess
-from cat.log import log
+import threading
+import functools
+import importlib.util
 from cat.mad_hatter.decorators import hook
+from .utils import log_error, log_event
 
-# Global variables for spaCy model
-_spacy_model = None
-_spacy_available = None
+@functools.lru_cache(maxsize=None)
+def is_sentiment_available() -> bool:
+    """Check if TextBlob is available, without it no sentiment is recorded."""
+    if importlib.util.find_spec("textblob") is not None:
+        return True
+    log_event("WARNING", "import_error", message="TextBlob not installed. Install with: pip install textblob")
+    return False
 
-def _check_spacy_availability() -> bool:
-    """Check if spaCy is available."""
-    global _spacy_available
-    if _spacy_available is not None:
-        return _spacy_available
-    
-    try:
-        import spacy
-        _spacy_available = True
-    except ImportError:
-        log.warning(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "import_error",
-            "data": {
-                "message": "spaCy not installed. Install with: pip install spacy"
-            }
-        }))
-        _spacy_available = False
-    
-    return _spacy_available
+def is_neutral_text(text: str) -> bool:
+    """Whether a text is too short to carry sentiment: fewer than 3 letters ("ok", emoji, numbers)."""
+    return sum(c.isalpha() for c in text[:64]) < 3
 
-def _download_model(model_name: str) -> bool:
-    """Download a spaCy model if not present."""
-    try:
-        log.info(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "model_download_start",
-            "data": {
-                "model_name": model_name
-            }
-        }))
-        
-        result = subprocess.run([
-            sys.executable, "-m", "spacy", "download", model_name
-        ], capture_output=True, text=True, timeout=300)
-        
-        if result.returncode == 0:
-            log.info(json.dumps({
-                "component": "ccat_oc_analytics",
-                "event": "model_download_success",
-                "data": {
-                    "model_name": model_name
-                }
-            }))
-            return True
-        else:
-            log.error(json.dumps({
-                "component": "ccat_oc_analytics",
-                "event": "model_download_error",
-                "data": {
-                    "model_name": model_name,
-                    "error": result.stderr
-                }
-            }))
-            return False
-    except subprocess.TimeoutExpired:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "model_download_timeout",
-            "data": {
-                "model_name": model_name
-            }
-        }))
-        return False
-    except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "model_download_error",
-            "data": {
-                "model_name": model_name,
-                "error": str(e)
-            }
-        }))
-        return False
+# Chats repeat short messages ("ok", "thanks", greetings) a lot, so only those are memoized.
+# Longer messages are not kept in memory
+_memo_max_length = 64
 
-def _get_spacy_model(model_name: str):
-    """Get or load a spaCy model, downloading if necessary."""
-    global _spacy_model
-    
-    if _spacy_model:
-        return _spacy_model
+def _polarity(text: str) -> float:
+    """Polarity of a text from TextBlob, clamped to [-1, 1]."""
+    from textblob import TextBlob
+    return max(-1.0, min(1.0, TextBlob(text).sentiment.polarity))
+
+@functools.lru_cache(maxsize=256)
+def _short_polarity(text: str) -> float:
+    return _polarity(text)
+
+def analyze_sentiment(text: str):
+    """Analyze sentiment using TextBlob.
     
-    if not _check_spacy_availability():
-        return None
+    Returns polarity score from -1 (negative) to 1 (positive),
+    or None if the sentiment could not be computed.
+    """
+    return analyze_sentiment_batch([text])[0]
+
+def analyze_sentiment_batch(texts):
+    """Analyze sentiment of several texts.
     
+    Returns a list of polarity scores from -1 (negative) to 1 (positive),
+    in the same order as the given texts. Scores are None if TextBlob is
+    not available or the analysis of that text failed, so no fake neutral is recorded.
+    """
+    if not is_sentiment_available():
+        return [None] * len(texts)
+    return [_score(text) for text in texts]
+
+def _score(text):
+    # Each text is scored on its own, so a failure only drops that text
     try:
-        import spacy
-        
-        # First try to load the model
-        try:
-            log.info(json.dumps({
-                "component": "ccat_oc_analytics",
-                "event": "model_load_start",
-                "data": {
-                    "model_name": model_name
-                }
-            }))
-            
-            nlp = spacy.load(model_name)
-            
-            # Add sentiment analysis component using spacytextblob
-            try:
-                from spacytextblob.spacytextblob import SpacyTextBlob
-                if 'spacytextblob' not in nlp.pipe_names:
-                    nlp.add_pipe('spacytextblob')
-                    log.info(json.dumps({
-                        "component": "ccat_oc_analytics",
-                        "event": "sentiment_component_added",
-                        "data": {
-                            "model_name": model_name
-                        }
-                    }))
-            except ImportError:
-                log.warning(json.dumps({
-                    "component": "ccat_oc_analytics",
-                    "event": "spacytextblob_not_found",
-                    "data": {
-                        "message": "spacytextblob not installed. Install with: pip install spacytextblob"
-                    }
-                }))
-            
-            _spacy_model = nlp
-            
-            log.info(json.dumps({
-                "component": "ccat_oc_analytics",
-                "event": "model_load_success",
-                "data": {
-                    "model_name": model_name
-                }
-            }))
-            return nlp
-        except OSError:
-            # Model not found, try to download it
-            log.info(json.dumps({
-                "component": "ccat_oc_analytics",
-                "event": "model_not_found",
-                "data": {
-                    "model_name": model_name,
-                    "message": "Attempting to download..."
-                }
-            }))
-            
-            if _download_model(model_name):
-                # Try loading again after download
-                try:
-                    nlp = spacy.load(model_name)
-                    
-                    # Add sentiment analysis component using spacytextblob
-                    try:
-                        from spacytextblob.spacytextblob import SpacyTextBlob
-                        if 'spacytextblob' not in nlp.pipe_names:
-                            nlp.add_pipe('spacytextblob')
-                    except ImportError:
-                        log.warning(json.dumps({
-                            "component": "ccat_oc_analytics",
-                            "event": "spacytextblob_not_found",
-                            "data": {
-                                "message": "spacytextblob not installed. Install with: pip install spacytextblob"
-                            }
-                        }))
-                    
-                    _spacy_model = nlp
-                    log.info(json.dumps({
-                        "component": "ccat_oc_analytics",
-                        "event": "model_load_success",
-                        "data": {
-                            "model_name": model_name,
-                            "after_download": True
-                        }
-                    }))
-                    return nlp
-                except OSError:
-                    log.error(json.dumps({
-                        "component": "ccat_oc_analytics",
-                        "event": "model_load_error",
-                        "data": {
-                            "model_name": model_name,
-                            "error": "Failed to load even after download"
-                        }
-                    }))
-                    return None
-            else:
-                return None
+        # Texts without enough letters are neutral, long texts are truncated
+        if is_neutral_text(text):
+            return 0.0
+        if len(text) <= _memo_max_length:
+            return _short_polarity(text)
+        return _polarity(text[:2000])
     except Exception as e:
-        log.error(json.dumps({
-            "component": "ccat_oc_analytics",
-            "event": "model_load_error",
-            "data": {
-                "error": str(e)
-            }
-        }))
+        log_error("sentiment_analysis_error", e)
         return None
 
-def analyze_sentiment(text: str):
-    """Analyze sentiment using spaCy with spacytextblob.
-    
-    Returns polarity score from -1 (negative) to 1 (positive).
-    Uses TextBlob sentiment analysis via spacytextblob extension.
-    """
-    model_name = "xx_sent_ud_sm"
-    nlp = _get_spacy_model(model_name)
-    
-    if nlp:
+def _warmup():
+    # TextBlob reads its sentiment lexicon on first use, score a throwaway text to load it
+    if is_sentiment_available():
         try:
-            # Truncate text to avoid processing very long texts
-            if len(text) > 2000:
-                text = text[:2000]
-            
-            doc = nlp(text)
-            
-            # spacytextblob provides polarity in doc._.polarity (ranges from -1 to 1)
-            # and subjectivity in doc._.subjectivity (ranges from 0 to 1)
-            if hasattr(doc._, 'polarity'):
-                polarity = doc._.polarity
-                # Ensure the value is within expected range
-                return max(-1.0, min(1.0, polarity))
-            else:
-                # Fallback: calculate average polarity from sentences
-                if doc.sents:
-                    polarities = [
-                        sent._.polarity if hasattr(sent._, 'polarity') else 0.0 
-                        for sent in doc.sents
-                    ]
-                    if polarities:
-                        avg_polarity = sum(polarities) / len(polarities)
-                        return max(-1.0, min(1.0, avg_polarity))
-                return 0.0
-            
+            _polarity("warmup")
         except Exception as e:
-            log.error(json.dumps({
-                "component": "ccat_oc_analytics",
-                "event": "sentiment_analysis_error",
-                "data": {
-                    "error": str(e)
-                }
-            }))
-            return 0.0
-    return 0.0
-
+            log_error("sentiment_analysis_error", e)
 
 @hook
 def after_cat_bootstrap(cat):
-    # Pre-download the SpaCy model for sentiment analysis
-    _get_spacy_model("xx_sent_ud_sm")
+    # Load the sentiment lexicon in the background, so the first user message doesn't pay for it
+    threading.Thread(target=_warmup, name="oc_analytics_sentiment_warmup", daemon=True).start()
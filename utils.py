@@ -0,0 +1,65 @@
+import time
+import json
+from collections import OrderedDict
+from cat.log import log
+from cat.mad_hatter.mad_hatter import MadHatter
+
+class LRUDict(OrderedDict):
+    """Dict holding at most maxsize keys, evicting the least recently set one.
+
+    Not thread safe: callers sharing one between threads must hold a lock around it.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+# Structured error log, built without an intermediate dict (the error is escaped by json.dumps)
+_ERROR_LOG_TEMPLATE = '{"component": "ccat_oc_analytics", "event": "%s", "data": {"error": %s}}'
+
+_LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+def _log_enabled(level):
+    threshold = str(getattr(log, "LOG_LEVEL", "DEBUG")).upper()
+    return _LOG_LEVELS.get(level, 0) >= _LOG_LEVELS.get(threshold, 0)
+
+def log_error(event, error):
+    """Log an error event with the plugin's structured JSON log format."""
+    if _log_enabled("ERROR"):
+        log.error(_ERROR_LOG_TEMPLATE % (event, json.dumps(str(error))))
+
+def log_event(level, event, **data):
+    """Log an event with the plugin's structured JSON log format.
+
+    The payload is serialized only if the Cat log level lets the message through.
+    """
+    if not _log_enabled(level):
+        return
+    getattr(log, level.lower())(json.dumps({"component": "ccat_oc_analytics", "event": event, "data": data}))
+
+# Other plugins' settings as plugin_id -> (loaded_at, settings)
+_settings_cache = {}
+_settings_cache_ttl = 30 # seconds
+
+def get_plugin_settings(plugin_id):
+    """Get the settings of another plugin, or None if the plugin is not active.
+
+    Settings are read from disk, so they are cached for a short time instead of
+    being loaded on every message. Plugin objects themselves are not kept, as
+    they are replaced when a plugin is reloaded.
+    """
+    now = time.monotonic()
+    cached = _settings_cache.get(plugin_id)
+    if cached and now - cached[0] < _settings_cache_ttl:
+        return cached[1]
+
+    plugin = MadHatter().plugins.get(plugin_id)
+    settings = plugin.load_settings() if plugin else None
+    _settings_cache[plugin_id] = (now, settings)
+    return settings